@@ -1,12 +1,37 @@
+import heapq
 import os
+import time
+import numpy as np
+import orjson
 import requests
-from woocommerce import API
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
+from operator import itemgetter
+from types import MappingProxyType
 
 # Load environment variables
 load_dotenv()
 
+# Shared session so every request reuses pooled connections (one TLS
+# handshake per host) and transient errors are retried with exponential
+# backoff instead of failing the whole run. POST (the TRMNL webhook) is
+# retried too - resending the same payload is idempotent.
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=20,
+    pool_maxsize=20,
+    max_retries=Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=("GET", "POST"),
+    )
+))
+
 WC_API_URL = os.getenv("WC_API_URL")
 WC_CONSUMER_KEY = os.getenv("WC_CONSUMER_KEY")
 WC_CONSUMER_SECRET = os.getenv("WC_CONSUMER_SECRET")
@@ -14,144 +39,383 @@ WEBHOOK_URL = os.getenv("WEBHOOK_URL")
 DEBUG = os.getenv("DEBUG", "False").lower() == "true"
 DAYS_RANGE = int(os.getenv("DAYS_RANGE", "30"))  # Default to 30 days
 
+STATE_FILE = "state.json"
+PRODUCTS_REFRESH_TTL = 86400  # Fully re-sync the product list once a day
+
+# Order statuses that count towards the dashboard totals
+COUNTED_STATUSES = frozenset({"pending", "processing", "on-hold", "completed"})
+
+CURRENCY_CACHE_FILE = ".currency_cache.json"
+CURRENCY_CACHE_TTL = 3600  # Re-check the store currency at most once an hour
+
+# Read-only mapping - MappingProxyType makes the immutability explicit
+CURRENCY_SYMBOLS = MappingProxyType({
+    "USD": "$", "EUR": "€", "GBP": "£", "JPY": "¥", "AUD": "$", "CAD": "$",
+    "NZD": "$", "MXN": "$", "CHF": "CHF", "SEK": "kr", "NOK": "kr",
+    "DKK": "kr", "PLN": "zł", "BRL": "R$", "INR": "₹", "CNY": "¥",
+})
+
+
+def api_get(endpoint, params=None):
+    """GET a WooCommerce REST endpoint through the pooled session."""
 
-def get_woocommerce_data():
-    """Fetch data from WooCommerce API using official library."""
-    
-    # Initialize WooCommerce API
     # Remove trailing slash from URL if present
-    api_url = WC_API_URL.rstrip('/')
-    
-    wcapi = API(
-        url=api_url,
-        consumer_key=WC_CONSUMER_KEY,
-        consumer_secret=WC_CONSUMER_SECRET,
-        version="wc/v3",
-        timeout=30,
-        wp_api=True,  # Use WordPress API path
-        query_string_auth=True  # Force query string auth for HTTPS
-    )
-    
+    url = f"{WC_API_URL.rstrip('/')}/wp-json/wc/v3/{endpoint}"
+
+    # Query string auth works on hosts that strip the Authorization header
+    params = {
+        **(params or {}),
+        "consumer_key": WC_CONSUMER_KEY,
+        "consumer_secret": WC_CONSUMER_SECRET,
+    }
+
+    return SESSION.get(url, params=params, timeout=30)
+
+
+def fetch_all_pages(endpoint, params, max_pages=100):
+    """Fetch all pages of a paginated endpoint, pages 2..N in parallel.
+
+    Returns None if any page fails, so callers can tell an error apart
+    from a genuinely empty result.
+    """
+
+    # Fetch the first page to learn the total page count from the headers
+    first_response = api_get(endpoint, params={**params, "per_page": 100, "page": 1})
+
+    if first_response.status_code != 200:
+        print(f"Error fetching {endpoint}: {first_response.status_code}")
+        print(f"Response: {first_response.json()}")
+        return None
+
+    # orjson parses the raw bytes noticeably faster than response.json()
+    results = orjson.loads(first_response.content)
+    total_pages = int(first_response.headers.get("X-WP-TotalPages", 1))
+
+    if total_pages > max_pages:
+        print(f"WARNING: {endpoint} has {total_pages} pages, limiting to {max_pages}")
+        total_pages = max_pages
+
+    if total_pages <= 1:
+        return results
+
+    def fetch_page(page):
+        print(f"Fetching {endpoint} page {page}...")
+        response = api_get(endpoint, params={**params, "per_page": 100, "page": page})
+
+        if response.status_code != 200:
+            print(f"Error fetching {endpoint} page {page}: {response.status_code}")
+            return None
+
+        return orjson.loads(response.content)
+
+    # Remaining pages are independent, so fetch them concurrently
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for page_results in executor.map(fetch_page, range(2, total_pages + 1)):
+            if page_results is None:
+                return None  # A truncated result must not look complete
+            results.extend(page_results)
+
+    return results
+
+
+def load_state():
+    """Load the cached order/product snapshot from the previous run."""
+
+    try:
+        with open(STATE_FILE, "rb") as f:
+            state = orjson.loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+    if state.get("url") != WC_API_URL:
+        return None  # Cache belongs to a different store
+
+    if state.get("days_range", 0) < DAYS_RANGE:
+        # The window was widened - orders between the old and new window
+        # start were never fetched, so incremental sync can't backfill them
+        return None
+
+    return state
+
+
+def save_state(state):
+    """Atomically persist the order/product snapshot for the next run."""
+
+    tmp_file = STATE_FILE + ".tmp"
+
+    try:
+        with open(tmp_file, "wb") as f:
+            f.write(orjson.dumps(state))
+        os.replace(tmp_file, STATE_FILE)
+    except OSError as e:
+        print(f"Warning: could not save state cache: {e}")
+
+
+def get_currency_symbol():
+    """Get the store's currency symbol, cached on disk between runs."""
+
+    # The store currency changes approximately never, so a short-lived
+    # disk cache saves one settings request on most runs
+    try:
+        with open(CURRENCY_CACHE_FILE, "rb") as f:
+            cache = orjson.loads(f.read())
+        if cache.get("url") == WC_API_URL and time.time() - cache.get("ts", 0) < CURRENCY_CACHE_TTL:
+            return cache["symbol"]
+    except (OSError, ValueError, KeyError):
+        pass  # Missing or unreadable cache - fall through to the API
+
+    response = api_get("settings/general")
+
+    if response.status_code != 200:
+        print(f"Error fetching store settings: {response.status_code}")
+        # Don't cache the fallback - retry the lookup on the next run
+        return "$"
+
+    settings = orjson.loads(response.content)
+    settings_by_id = {s["id"]: s["value"] for s in settings}
+    currency = settings_by_id.get("woocommerce_currency", "USD")
+    symbol = CURRENCY_SYMBOLS.get(currency, f"{currency} ")
+
+    try:
+        with open(CURRENCY_CACHE_FILE, "wb") as f:
+            f.write(orjson.dumps({"url": WC_API_URL, "ts": time.time(), "symbol": symbol}))
+    except OSError:
+        pass  # Cache is best-effort only
+
+    return symbol
+
+
+def get_woocommerce_data():
+    """Fetch data from the WooCommerce REST API."""
+
     try:
         # Get orders from configured date range
         days_ago = (datetime.now() - timedelta(days=DAYS_RANGE)).isoformat()
         
-        # Fetch all orders (paginated)
-        all_orders = []
-        page = 1
-        per_page = 100
-        
-        print(f"Fetching orders from last {DAYS_RANGE} days (after {days_ago})...")
-        
-        while True:
-            print(f"Fetching page {page}...")
-            response = wcapi.get("orders", params={
-                "per_page": per_page,
-                "page": page,
-                "after": days_ago
-            })
-            
-            if response.status_code != 200:
-                print(f"Error fetching orders: {response.status_code}")
-                print(f"Response: {response.json()}")
-                break
-            
-            orders = response.json()
-            if not orders:
-                print(f"No more orders found. Total fetched: {len(all_orders)}")
-                break
-                
-            all_orders.extend(orders)
-            print(f"Fetched {len(orders)} orders (total so far: {len(all_orders)})")
-            page += 1
-            
-            # Increased safety limit - adjust if you have even more orders
-            if page > 100:  # Now allows up to 10,000 orders
-                print(f"WARNING: Reached safety limit of 100 pages. Total orders: {len(all_orders)}")
-                break
-        
-        # Calculate metrics
-        total_sales = sum(float(order.get("total", 0)) for order in all_orders)
-        total_orders = len(all_orders)
-        
-        # Count order statuses
-        pending_orders = sum(1 for order in all_orders if order.get("status") == "pending")
-        processing_orders = sum(1 for order in all_orders if order.get("status") == "processing")
-        completed_orders = sum(1 for order in all_orders if order.get("status") == "completed")
-        fulfilled_orders = completed_orders  # Completed = Fulfilled
-        
-        # Calculate products sold
-        products_sold = 0
-        for order in all_orders:
-            for item in order.get("line_items", []):
-                products_sold += item.get("quantity", 0)
-        
-        # Get low stock products
-        print("Fetching product inventory data...")
-        
-        # Fetch all products with stock management enabled
-        all_products = []
-        page = 1
-        
-        while True:
-            products_response = wcapi.get("products", params={
-                "per_page": 100,
-                "page": page,
+        run_started = datetime.now()
+        state = load_state()
+
+        # _fields trims each record to just what we read - full order
+        # and product objects are dozens of fields of dead weight
+        orders_params = {
+            "after": days_ago,
+            "_fields": "id,date_created,status,total,line_items.quantity"
+        }
+        products_params = {
+            "_fields": "id,name,type,status,stock_quantity,low_stock_amount,"
+                       "manage_stock,stock_status"
+        }
+
+        # Deleted and trashed products never appear in a modified_after
+        # delta, so a purely incremental product cache would keep them
+        # forever - rebuild the product snapshot from scratch once a day
+        products_full_refresh = (
+            state is None
+            or time.time() - state.get("products_synced", 0) > PRODUCTS_REFRESH_TTL
+        )
+
+        if state:
+            # Incremental run: only rows modified since the last run cross
+            # the wire. No server-side status filters here - transitions
+            # out of scope (cancellations, unpublished products) have to
+            # be observed so the cached rows can be evicted.
+            print(f"Incremental fetch of changes since {state['last_run']}...")
+            orders_params["modified_after"] = state["last_run"]
+        else:
+            print(f"Fetching orders from last {DAYS_RANGE} days (after {days_ago})...")
+            # Only ask for statuses the dashboard counts - cancelled,
+            # failed and trashed orders never cross the wire
+            orders_params["status"] = "pending,processing,on-hold,completed"
+
+        if products_full_refresh:
+            products_params.update({
+                "status": "publish",  # Drafts and trash are filtered server-side
                 "stock_status": "instock",
                 "manage_stock": True  # Only products with stock management
             })
-            
-            if products_response.status_code != 200:
-                print(f"Error fetching products: {products_response.status_code}")
-                break
-            
-            products = products_response.json()
-            if not products:
-                break
-                
-            all_products.extend(products)
-            page += 1
-            
+        else:
+            products_params["modified_after"] = state["last_run"]
+
+        print("Fetching product inventory data...")
+
+        # Orders, products and settings are independent resources, so
+        # issue all three up front instead of waiting on each in turn
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            # Safety limit of 100 pages allows up to 10,000 orders
+            orders_future = executor.submit(fetch_all_pages, "orders", orders_params, 100)
             # Limit to 5 pages (500 products) for performance
-            if page > 5:
-                break
+            products_future = executor.submit(fetch_all_pages, "products", products_params, 5)
+            # On a cache miss this is one settings request - overlap it too
+            currency_future = executor.submit(get_currency_symbol)
+
+            fetched_orders = orders_future.result()
+            fetched_products = products_future.result()
+            currency_symbol = currency_future.result()
+
+        # A failed fetch must not be persisted as "no rows" - incremental
+        # runs would never re-fetch the hole. Render what we have, but
+        # leave the state untouched so the next run retries.
+        fetch_failed = fetched_orders is None or fetched_products is None
+        if fetched_orders is None:
+            fetched_orders = []
+        if fetched_products is None:
+            fetched_products = []
+
+        # Merge the fetched rows into the cached snapshot (JSON object
+        # keys are strings, so ids are keyed as str)
+        orders_by_id = state.get("orders", {}) if state else {}
+        for order in fetched_orders:
+            key = str(order.get("id"))
+            if order.get("status") in COUNTED_STATUSES:
+                orders_by_id[key] = order
+            else:
+                orders_by_id.pop(key, None)  # e.g. cancelled since last run
+
+        # Drop orders that have aged out of the reporting window
+        orders_by_id = {
+            key: order for key, order in orders_by_id.items()
+            if order.get("date_created", "") >= days_ago
+        }
+
+        # On a full refresh the fetched rows are the whole tracked set
+        products_by_id = {} if products_full_refresh else state.get("products", {})
+        for product in fetched_products:
+            key = str(product.get("id"))
+            # Variable parents manage stock on their variations, so their
+            # own manage_stock flag is False - keep them regardless
+            if (product.get("status", "publish") == "publish"
+                    and product.get("stock_status", "instock") == "instock"
+                    and (product.get("type") == "variable"
+                         or product.get("manage_stock", True))):
+                products_by_id[key] = product
+            else:
+                products_by_id.pop(key, None)  # No longer in the tracked set
+
+        all_orders = list(orders_by_id.values())
+        all_products = list(products_by_id.values())
+
+        if fetch_failed:
+            print("Skipping state save after fetch error - will re-fetch next run")
+        else:
+            save_state({
+                "url": WC_API_URL,
+                # Small overlap guards against clock skew; upserts are idempotent
+                "last_run": (run_started - timedelta(minutes=5)).isoformat(),
+                "days_range": DAYS_RANGE,
+                "products_synced": time.time() if products_full_refresh
+                                   else state.get("products_synced", 0),
+                "orders": orders_by_id,
+                "products": products_by_id,
+            })
+
+        print(f"Fetched {len(fetched_orders)} changed orders ({len(all_orders)} in window)")
         
-        print(f"Found {len(all_products)} products with stock management")
+        # One Counter sweep yields every status count at once; NumPy
+        # handles the numeric reductions over contiguous arrays
+        status_counts = Counter(order.get("status") for order in all_orders)
+
+        # Cancelled orders don't count towards sales
+        total_orders = len(all_orders) - status_counts.get("cancelled", 0)
+        pending_orders = status_counts.get("pending", 0)
+        processing_orders = status_counts.get("processing", 0)
+        completed_orders = status_counts.get("completed", 0)
+        fulfilled_orders = completed_orders  # Completed = Fulfilled
+
+        totals = np.array(
+            [float(order.get("total", 0)) for order in all_orders
+             if order.get("status") != "cancelled"],
+            dtype=np.float64,
+        )
+        total_sales = float(totals.sum())
+
+        quantities = np.fromiter(
+            (item.get("quantity", 0)
+             for order in all_orders if order.get("status") != "cancelled"
+             for item in order.get("line_items", [])),
+            dtype=np.int64,
+        )
+        products_sold = int(quantities.sum())
         
+        # Get low stock products
+        print(f"Found {len(all_products)} products with stock management")
+
+        # Variable products track stock on their variations - instead of
+        # one /variations request per product, ask the products endpoint
+        # for all variations of up to 100 parents at once and group the
+        # results by parent
+        variable_products = [p for p in all_products if p.get("type") == "variable"]
+        product_variations = defaultdict(list)
+
+        if variable_products:
+            print(f"Fetching variations for {len(variable_products)} variable products...")
+
+            variable_ids = [product["id"] for product in variable_products]
+
+            for i in range(0, len(variable_ids), 100):
+                parent_ids = ",".join(str(pid) for pid in variable_ids[i:i + 100])
+                variations = fetch_all_pages("products", {
+                    "type": "variation",
+                    "parent": parent_ids,
+                    "_fields": "parent_id,stock_quantity,low_stock_amount,attributes"
+                }, 5) or []  # Variations aren't cached, so a failure only affects this run
+
+                for variation in variations:
+                    product_variations[variation.get("parent_id")].append(variation)
+
         # Filter and sort products by stock quantity
         low_stock_products = []
+
+        def check_stock(item, name):
+            # The API schema guarantees numeric stock fields, so coerce
+            # once and let unmanaged items (stock_quantity null) bail out
+            try:
+                stock_qty = int(item["stock_quantity"])
+            except (KeyError, TypeError, ValueError):
+                return
+
+            low_stock_threshold = item.get("low_stock_amount")
+            # If no threshold set, use default of 5
+            if low_stock_threshold is None:
+                low_stock_threshold = 5
+
+            if 0 <= stock_qty <= low_stock_threshold:
+                low_stock_products.append({
+                    "name": name,
+                    "stock": stock_qty,
+                    "threshold": int(low_stock_threshold)
+                })
+
         for product in all_products:
-            stock_qty = product.get("stock_quantity")
-            # Include products with stock quantity (not None) that are low
-            if stock_qty is not None and isinstance(stock_qty, (int, float)):
-                low_stock_threshold = product.get("low_stock_amount")
-                # If no threshold set, use default of 5
-                if low_stock_threshold is None:
-                    low_stock_threshold = 5
-                
-                if stock_qty <= low_stock_threshold and stock_qty >= 0:
-                    low_stock_products.append({
-                        "name": product.get("name", "Unknown"),
-                        "stock": int(stock_qty),
-                        "threshold": int(low_stock_threshold)
-                    })
+            if product.get("type") == "variable":
+                # Check each variation's own stock level
+                for variation in product_variations.get(product["id"], []):
+                    options = ", ".join(
+                        attr.get("option", "") for attr in variation.get("attributes", [])
+                    )
+                    name = product.get("name", "Unknown")
+                    if options:
+                        name = f"{name} ({options})"
+                    check_stock(variation, name)
+            else:
+                check_stock(product, product.get("name", "Unknown"))
         
-        # Sort by stock quantity (lowest first)
-        low_stock_products.sort(key=lambda x: x["stock"])
+        # Only the five lowest items are displayed, so pick them with a
+        # bounded heap instead of sorting the whole list
+        low_stock_top5 = heapq.nsmallest(5, low_stock_products, key=itemgetter("stock"))
         
         print(f"Found {len(low_stock_products)} low stock items")
-        
+
         # Prepare data for TRMNL
         data = {
             "merge_variables": {
-                "total_sales": f"${total_sales:,.2f}",
+                "total_sales": f"{currency_symbol}{total_sales:,.2f}",
                 "total_orders": total_orders,
                 "products_sold": products_sold,
                 "pending_orders": pending_orders,
                 "processing_orders": processing_orders,
                 "fulfilled_orders": fulfilled_orders,
                 "low_stock_count": len(low_stock_products),
-                "low_stock_items": low_stock_products[:5],  # Top 5 for display
+                "low_stock_items": low_stock_top5,  # Top 5 for display
                 "last_updated": datetime.now().strftime("%Y-%m-%d %H:%M")
             }
         }
@@ -168,13 +432,16 @@ def send_to_trmnl(data):
     
     if DEBUG:
         print("DEBUG MODE: Would send to TRMNL:")
-        print(data)
+        # Pretty-printing is only paid for when debugging
+        print(orjson.dumps(data, option=orjson.OPT_INDENT_2).decode())
         return True
-    
+
     try:
-        response = requests.post(
+        # Serialize once with orjson and post the bytes directly, instead
+        # of letting requests re-encode the payload with stdlib json
+        response = SESSION.post(
             WEBHOOK_URL,
-            json=data,
+            data=orjson.dumps(data),
             headers={"Content-Type": "application/json"},
             timeout=30
         )